@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+"""Builds the optional native extensions
+
+Build them next to the sources with:
+    python3 setup.py build_ext --inplace
+
+_checksum is the packet checksum and _tunnel the batched packet I/O and
+header writing. The tunnel falls back to Python for each one that isn't built.
+_tunnel uses recvmmsg/sendmmsg, so it is only built on Linux.
+"""
+import sys
+from setuptools import setup, Extension
+
+extensions = [
+    Extension("src._checksum", ["src/_checksum.c"], depends=["src/checksum.h"], extra_compile_args=["-O3"]),
+]
+
+if sys.platform.startswith("linux"):
+    extensions.append(Extension("src._tunnel", ["src/_tunnel.c"], depends=["src/checksum.h"], extra_compile_args=["-O3"]))
+
+setup(
+    name="IcmpTunnel",
+    py_modules=[],
+    ext_modules=extensions,
+)
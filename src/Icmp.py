@@ -4,13 +4,73 @@
 Attributes:
     ICMP_ECHO_REPLY (int): ICMP echo reply constant
     ICMP_ECHO_REQUEST (int): ICMP echo request constant
+    NUMPY_CHECKSUM_MIN_SIZE (int): Smallest packet to checksum with numpy when numba is also available
+    NUMPY_NO_NUMBA_CHECKSUM_MIN_SIZE (int): Smallest packet to checksum with numpy when numba isn't available
 """
 import socket
 import struct
 from Logger import logger
 
+try:
+    import _checksum
+except ImportError:
+    _checksum = None
+
+try:
+    import _tunnel
+except ImportError:
+    _tunnel = None
+
+# Only Checksum's fallbacks use them, and numba takes a while to import and compile
+numpy = None
+numba = None
+if _checksum is None:
+    try:
+        import numpy
+    except ImportError:
+        pass
+
+    try:
+        import numba
+    except ImportError:
+        pass
+
 ICMP_ECHO_REPLY = 0
 ICMP_ECHO_REQUEST = 8
+NUMPY_CHECKSUM_MIN_SIZE = 8192
+NUMPY_NO_NUMBA_CHECKSUM_MIN_SIZE = 1024
+
+if numba is not None:
+    @numba.njit(cache=True, boundscheck=False)
+    def _checksum_nb(buf):
+        """Calculates a packet checksum in a compiled loop, used for small packets
+
+        Args:
+            buf (bytes): Array of bytes to calculates its checksum
+
+        Returns:
+            int: Calculated checksum
+        """
+        length = len(buf)
+        checksum = 0
+        for index in range(0, length - 1, 2):
+            checksum += (buf[index] << 8) | buf[index + 1]
+
+        # We have a leftover byte
+        if length & 1:
+            checksum += buf[length - 1] << 8
+
+        checksum = (checksum >> 16) + (checksum & 0xFFFF)
+        checksum = checksum + (checksum >> 16)
+        return ~checksum & 0xFFFF
+
+    # Compile now so the first packet doesn't pay for it. numba compiles once per
+    # argument type and packets come as bytes, bytearray and (read only) memoryview slices
+    for _buffer in (bytes(64), bytearray(64), memoryview(bytearray(64)), memoryview(bytes(64))):
+        _checksum_nb(_buffer)
+    del _buffer
+else:
+    _checksum_nb = None
 
 class IcmpPacket(object):
 
@@ -18,14 +78,21 @@ class IcmpPacket(object):
 
     Attributes:
         checksum (int): Packets checksum
+        CHECKSUM_OFFSET (int): Offset of the checksum field in the ICMP header
         code (int): ICMP packet code
         dst ((IP, Port)): Destination of the tcp packet that will receive the packet
+        dstPacked (bytes): Destination IP packed with inet_aton, None if not known yet
         ICMP_HEADER (str): ICMP header parsing string
         ICMP_HEADER_SIZE (int): ICMP header size
         id (int): ICMP packet id
         IP_HEADER (str): IP packet header parsing string
         IP_HEADER_SIZE (int): IP header size
+        _IP (struct.Struct): Compiled IP_HEADER
+        _ICMP (struct.Struct): Compiled ICMP_HEADER
+        _CHECKSUM (struct.Struct): Compiled checksum field
         MAGIC (int): Magic to validate its a tunnel packet
+        MAGIC_OFFSET (int): Offset of the magic field in the ICMP header
+        _MAGIC_BYTES (bytes): MAGIC as it is on the wire
         magic (int): Magic to validate its a tunnel packet
         payload (bytearray): ICMP packet payload
         sequence (int): ICMP packet sequence
@@ -37,10 +104,20 @@ class IcmpPacket(object):
     ICMP_HEADER =  "!BBHHH4sHL"
     MAGIC = 0x24426886
 
-    IP_HEADER_SIZE = struct.calcsize(IP_HEADER)
-    ICMP_HEADER_SIZE = struct.calcsize(ICMP_HEADER)
+    # Compiled once instead of parsing the format string on every packet
+    _IP = struct.Struct(IP_HEADER)
+    _ICMP = struct.Struct(ICMP_HEADER)
+    _CHECKSUM = struct.Struct("!H")
+    CHECKSUM_OFFSET = 2
+
+    IP_HEADER_SIZE = _IP.size
+    ICMP_HEADER_SIZE = _ICMP.size
+
+    # The magic is the header's last field
+    _MAGIC_BYTES = struct.pack("!L", MAGIC)
+    MAGIC_OFFSET = ICMP_HEADER_SIZE - len(_MAGIC_BYTES)
 
-    def __init__(self, type, code, checksum, id, sequence, payload, srcIp, dst = (None, None), magic = MAGIC):
+    def __init__(self, type, code, checksum, id, sequence, payload, srcIp, dst = (None, None), magic = MAGIC, dstPacked = None):
         """Holds information about an ICMP packet
 
         Args:
@@ -53,6 +130,7 @@ class IcmpPacket(object):
             srcIp (IP): Senders Ip
             dst ((IP, Port), optional): Destination of the tcp packet that will receive the packet
             magic (int, optional): magic number for the IcmpTunnel
+            dstPacked (bytes, optional): Destination IP already packed with inet_aton, saves packing it per packet
         """
         self.type = type
         self.code = code
@@ -63,6 +141,7 @@ class IcmpPacket(object):
         self.srcIp = srcIp
         self.dst = dst
         self.magic = magic
+        self.dstPacked = dstPacked
 
     def Create(self):
         """Creates a network ready ICMP packet from the saved data
@@ -70,55 +149,102 @@ class IcmpPacket(object):
         Returns:
             bytearray: Serialized ICMP packet data
         """
-        logger.Log("DEBUG", "Creating ICMP packet")
+        # Per packet, compiled out with python -O
+        if __debug__ and logger.IsEnabledFor("DEBUG"):
+            logger.Log("DEBUG", "Creating ICMP packet")
 
-        packStr = self.ICMP_HEADER
-        packArgs = [self.type, self.code, 0, self.id, self.sequence, socket.inet_aton(self.dst[0]), self.dst[1], self.magic]
+        if self.dstPacked is None:
+            self.dstPacked = socket.inet_aton(self.dst[0])
 
-        # Add the payload
-        if len(self.payload) > 0:
-            packStr += "{}s".format(len(self.payload))
-            packArgs.append(self.payload)
+        # Pack once with a zero checksum, then patch the checksum in place
+        size = self.ICMP_HEADER_SIZE + len(self.payload)
+        packet = bytearray(size)
+        self._ICMP.pack_into(packet, 0, self.type, self.code, 0, self.id, self.sequence, self.dstPacked, self.dst[1], self.magic)
+        packet[self.ICMP_HEADER_SIZE:] = self.payload
 
-        # Add correct checksum
-        checksum = self.Checksum(struct.pack(packStr, *packArgs))
-        packArgs[2] = checksum
+        self._CHECKSUM.pack_into(packet, self.CHECKSUM_OFFSET, self.Checksum(packet))
 
-        return struct.pack(packStr, *packArgs)
+        return packet
 
     @classmethod
-    def Parse(cls, packet):
-        """Parses a received network packet into an ICMP packet
+    def WriteHeader(cls, buffer, size, type, code, dstPacked, dstPort, id = 0, sequence = 0, magic = MAGIC):
+        """Writes an ICMP header in front of a payload that is already in the buffer right after the header room.
+        Faster than Create as no IcmpPacket is built or copied and the header and payload are summed in one pass
 
         Args:
-            packet (bytearray): Network packet
+            buffer (bytearray): Buffer with the payload at ICMP_HEADER_SIZE
+            size (int): Size of the whole packet, header included
+            type (int): ICMP packet type
+            code (int): ICMP packet code
+            dstPacked (bytes): Destination IP packed with inet_aton
+            dstPort (int): Destination port
+            id (int, optional): ICMP packet id
+            sequence (int, optional): ICMP packet sequence
+            magic (int, optional): magic number for the IcmpTunnel
 
         Returns:
-            IcmpPacket: Parsed packet
+            int: Size of the header
         """
-        rawIpPacket, rawIcmpPacket = packet[:IcmpPacket.IP_HEADER_SIZE], packet[IcmpPacket.IP_HEADER_SIZE:]
-        ipPacket = struct.unpack(IcmpPacket.IP_HEADER, rawIpPacket)
+        # Native extension, built with setup.py
+        if _tunnel is not None:
+            return _tunnel.write_header(buffer, size, type, code, id, sequence, dstPacked, dstPort, magic)
 
-        srcIp = ipPacket[8]
+        cls._ICMP.pack_into(buffer, 0, type, code, 0, id, sequence, dstPacked, dstPort, magic)
+        cls._CHECKSUM.pack_into(buffer, cls.CHECKSUM_OFFSET, cls.Checksum(memoryview(buffer)[:size]))
+        return cls.ICMP_HEADER_SIZE
 
-        # Get the payload
-        payload = ""
-        payloadSize = len(rawIcmpPacket) - IcmpPacket.ICMP_HEADER_SIZE
-        if payloadSize > 0:
-            payload = struct.unpack("{}s".format(payloadSize), rawIcmpPacket[IcmpPacket.ICMP_HEADER_SIZE:])[0]
+    @classmethod
+    def Parse(cls, packet, ipHeader = True):
+        """Parses a received network packet into an ICMP packet
 
+        Args:
+            packet (bytes-like): Network packet
+            ipHeader (bool, optional): The packet starts with its IP header, as received on raw sockets.
+                Unprivileged (SOCK_DGRAM) ICMP sockets receive the ICMP packet alone, and srcIp is left None
 
-        logger.Log("DEBUG", "Parsing ICMP packet, payload size {}".format(payloadSize))
+        Returns:
+            IcmpPacket: Parsed packet, its payload is a memoryview of packet
+        """
+        # Read straight from the received buffer, nothing is copied
+        view = memoryview(packet)
+        offset = 0
+        srcIp = None
+        if ipHeader:
+            srcIp = socket.inet_ntoa(cls._IP.unpack_from(view, 0)[8])
+            offset = cls.IP_HEADER_SIZE
 
         # Read the packet data
-        type, code, checksum, id, sequence, dstIp, dstPort, magic = struct.unpack(IcmpPacket.ICMP_HEADER, rawIcmpPacket[:IcmpPacket.ICMP_HEADER_SIZE])
+        type, code, checksum, id, sequence, dstIp, dstPort, magic = cls._ICMP.unpack_from(view, offset)
+
+        # The payload is whatever follows the headers
+        payload = view[offset + cls.ICMP_HEADER_SIZE:]
+
+        if __debug__ and logger.IsEnabledFor("DEBUG"):
+            logger.Log("DEBUG", "Parsing ICMP packet, payload size {}", len(payload))
 
         # Convert to net data
-        srcIp = socket.inet_ntoa(srcIp)
         dst = (socket.inet_ntoa(dstIp), dstPort)
 
-        return cls(type, code, checksum, id, sequence, payload, srcIp, dst, magic)
+        return cls(type, code, checksum, id, sequence, payload, srcIp, dst, magic, dstIp)
+
+    @classmethod
+    def TryParse(cls, packet, ipHeader = True):
+        """Parses a received network packet only if it is a tunnel packet.
+        Most ICMP traffic on the interface isn't ours, so the size and magic are checked before parsing anything
+
+        Args:
+            packet (bytes-like): Network packet
+            ipHeader (bool, optional): The packet starts with its IP header, see Parse
+
+        Returns:
+            IcmpPacket: Parsed packet, None if it isn't a tunnel packet
+        """
+        start = cls.IP_HEADER_SIZE if ipHeader else 0
+        offset = start + cls.MAGIC_OFFSET
+        if len(packet) < start + cls.ICMP_HEADER_SIZE or packet[offset:offset + 4] != cls._MAGIC_BYTES:
+            return None
 
+        return cls.Parse(packet, ipHeader)
 
     @staticmethod
     def Checksum(packet):
@@ -130,22 +256,39 @@ class IcmpPacket(object):
         Returns:
             int: Calculated checksum
         """
-        checksum = 0
-        length = (len(packet) // 2) * 2
-
-        # Sum everything
-        for index in range(0, length, 2):
-            checksum = (checksum + packet[index] +  (packet[index + 1] * 256)) & 0XFFFFFFFF
-
-        # We have a leftover byte
-        if length < len(packet):
-            checksum = (checksum + packet[len(packet) - 1]) & 0XFFFFFFFF
-
-        # Calculate the data
-        checksum = (checksum >> 16) + (checksum & 0xFFFF)
-        checksum = checksum + (checksum >> 16)
-
-        answer = ~checksum & 0xFFFF
-        answer = (answer >> 8) | ((answer << 8) & 0xFF00)
-        return answer
-
+        # Native extension, built with setup.py
+        if _checksum is not None:
+            return _checksum.checksum(packet)
+
+        # numpy's call overhead is bigger than the work until packets get this big
+        if _checksum_nb is not None and len(packet) < NUMPY_CHECKSUM_MIN_SIZE:
+            return _checksum_nb(packet)
+
+        # Without numba, small packets are faster with the plain integer sum below
+        if numpy is not None and len(packet) >= NUMPY_NO_NUMBA_CHECKSUM_MIN_SIZE:
+            # Sum the big endian 16 bit words in numpy's C loop
+            length = len(packet) // 2
+            checksum = int(numpy.frombuffer(packet, dtype=">u2", count=length).sum(dtype=numpy.uint64))
+
+            # We have a leftover byte
+            if length * 2 < len(packet):
+                checksum += packet[len(packet) - 1] << 8
+
+            # Fold the carries, the sum is already in network order
+            checksum = (checksum >> 16) + (checksum & 0xFFFF)
+            checksum = checksum + (checksum >> 16)
+            return ~checksum & 0xFFFF
+
+        # Read the whole packet as one big endian number, every 16 bit word is a digit in base 2^16.
+        # Since 2^16 == 1 (mod 0xFFFF) the number mod 0xFFFF is the folded sum of its words
+        checksum = int.from_bytes(packet, "big")
+
+        # We have a leftover byte, pad it to a full word
+        if len(packet) & 1:
+            checksum <<= 8
+
+        # Carry folding never results in 0 unless all the words were 0
+        if checksum:
+            checksum = checksum % 0xFFFF or 0xFFFF
+
+        return ~checksum & 0xFFFF
@@ -7,6 +7,24 @@ import argparse
 from Tunnel import *
 from Logger import logger
 
+def TcpBufferSize(value):
+    """Parses the --tcp-buffer-size flag
+
+    Args:
+        value (str): Flag value
+
+    Returns:
+        int: TCP buffer size
+
+    Raises:
+        argparse.ArgumentTypeError: The size isn't between 1 and MAX_TCP_BUFFER_SIZE
+    """
+    size = int(value)
+    if not 1 <= size <= MAX_TCP_BUFFER_SIZE:
+        raise argparse.ArgumentTypeError("must be between 1 and {}".format(MAX_TCP_BUFFER_SIZE))
+
+    return size
+
 def main():
     """ICMP Tunnel, send TCP over ICMP
 
@@ -26,6 +44,10 @@ optional arguments:
                         Remote IP to send TCP connection to
   -dp DESTINATION_PORT, --destination-port DESTINATION_PORT
                         Remote port to send TCP connection to
+  -b TCP_BUFFER_SIZE, --tcp-buffer-size TCP_BUFFER_SIZE
+                        Maximum TCP data sent in one ICMP packet, up to 65497. MTU - 38 avoids IP fragmentation
+  -t, --send-thread     Send the ICMP packets from a background thread
+  -i, --icmp-thread     Handle the ICMP socket on a thread of its own
   -v, --verbose         Print debug messages
     """
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="ICMP Tunnel, send TCP over ICMP")
@@ -37,6 +59,9 @@ optional arguments:
     parser.add_argument("-lp", "--local-port", type=int, help="Local port for incoming TCP connections")
     parser.add_argument("-dh", "--destination-host", help="Remote IP to send TCP connection to")
     parser.add_argument("-dp", "--destination-port", type=int, help="Remote port to send TCP connection to")
+    parser.add_argument("-b", "--tcp-buffer-size", type=TcpBufferSize, default=TCP_BUFFER_SIZE, help="Maximum TCP data sent in one ICMP packet, up to {}. MTU - 38 avoids IP fragmentation".format(MAX_TCP_BUFFER_SIZE))
+    parser.add_argument("-t", "--send-thread", default=False, action="store_true", help="Send the ICMP packets from a background thread")
+    parser.add_argument("-i", "--icmp-thread", default=False, action="store_true", help="Handle the ICMP socket on a thread of its own")
     parser.add_argument("-v", "--verbose", default=False, action="store_true", help="Print debug messages")
     args = parser.parse_args()
 
@@ -45,7 +70,7 @@ optional arguments:
 
     if args.type == "server":
         logger.Log("INFO", "Starting server")
-        Server().Run()
+        Server(tcpBufferSize=args.tcp_buffer_size, sendThread=args.send_thread, icmpThread=args.icmp_thread).Run()
 
     else:
         # Make sure we have all params
@@ -57,7 +82,7 @@ optional arguments:
             parser.error("client requires proxy,local and destination flags")
 
         logger.Log("INFO", "Starting client")
-        ClientProxy(args.proxy_host, args.local_host, args.local_port, args.destination_host, args.destination_port).Run()
+        ClientProxy(args.proxy_host, args.local_host, args.local_port, args.destination_host, args.destination_port, args.tcp_buffer_size, args.send_thread, args.icmp_thread).Run()
 
 
 if __name__ == "__main__":
@@ -23,17 +23,32 @@ class Logger(object):
         """
         self.verbose = verbose
 
-    def Log(self, level, message):
+    def IsEnabledFor(self, level):
+        """Checks if messages of a level are printed, so callers can skip building them
+
+        Args:
+            level (str): Log level
+
+        Returns:
+            bool: True if messages of the level are printed
+        """
+        return level != "DEBUG" or self.verbose
+
+    def Log(self, level, message, *args):
         """Summary
 
         Args:
             level (str): Log level
-            message (str): Message to print
+            message (str): Message to print, formatted with args only if it is printed
+            *args: Arguments for message.format
         """
         # Don't print debug messages if we are not verbose
-        if level == "DEBUG" and not self.verbose:
+        if not self.IsEnabledFor(level):
             return
 
+        if args:
+            message = message.format(*args)
+
         print("{}: {}".format(str(level), str(message)))
 
         # Exit if it is fatal
@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+"""Batched datagram I/O, receives or sends several datagrams in a single syscall
+
+Uses Linux recvmmsg/sendmmsg through the _tunnel extension when it's built,
+through ctypes otherwise. On other platforms (or if libc doesn't have them) it
+falls back to one recvfrom_into/sendto per datagram.
+
+Attributes:
+    BATCH_SIZE (int): Default number of datagrams per batch
+    SEND_THREAD_BATCHES (int): Default number of batches a SendThread fills and sends in turns
+"""
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import sys
+import threading
+from Logger import logger
+
+try:
+    import _tunnel
+except ImportError:
+    _tunnel = None
+
+BATCH_SIZE = 32
+SEND_THREAD_BATCHES = 4
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+def _LoadLibc():
+    """Loads libc with recvmmsg and sendmmsg
+
+    Returns:
+        ctypes.CDLL: libc, None if recvmmsg/sendmmsg aren't available
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.recvmmsg.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+_libc = _LoadLibc()
+
+
+class MessageBatch(object):
+
+    """Preallocated datagram buffers that are received or sent together
+
+    Receiving fills the buffers from the start. Sending is done by writing a
+    datagram into NextBuffer(), queueing it with Push() and sending everything
+    queued with Flush(). Data received into NextView() after the room for a
+    header is already in place, pushing it with the header size included
+    sends both from the one buffer.
+
+    Attributes:
+        addresses (list): Address of each datagram in the batch
+        buffers (list): bytearray for each datagram in the batch
+        count (int): Number of datagrams in the batch
+        lengths (list): Length of each datagram in the batch
+        pending (int): Number of datagrams queued for sending
+        views (list): memoryview for each buffer
+    """
+
+    def __init__(self, count=BATCH_SIZE, size=65565):
+        """Allocates the batch buffers
+
+        Args:
+            count (int, optional): Number of datagrams in the batch
+            size (int, optional): Maximum size of a single datagram
+        """
+        self.count = count
+        self.buffers = [bytearray(size) for _ in range(count)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.lengths = [0] * count
+        self.addresses = [None] * count
+        self.pending = 0
+        self._size = size
+
+        # Packed send addresses, sendmmsg needs them as sockaddr_in
+        self._packedAddresses = {}
+
+        # The extension builds its own message headers on each call
+        if _tunnel is not None or _libc is None:
+            return
+
+        # Point every message header to its own buffer and address
+        self._headers = (_MMsgHdr * count)()
+        self._vectors = (_IoVec * count)()
+        self._names = (_SockAddrIn * count)()
+        self._data = [(ctypes.c_char * size).from_buffer(buffer) for buffer in self.buffers]
+
+        for index in range(count):
+            self._vectors[index].iov_base = ctypes.addressof(self._data[index])
+            self._vectors[index].iov_len = size
+            header = self._headers[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._names[index])
+            header.msg_namelen = ctypes.sizeof(_SockAddrIn)
+            header.msg_iov = ctypes.pointer(self._vectors[index])
+            header.msg_iovlen = 1
+
+    def Receive(self, sock):
+        """Receives as many waiting datagrams as fit in the batch without blocking
+
+        Args:
+            sock (socket): Socket to receive from, should have data waiting
+
+        Returns:
+            int: Number of datagrams received, read them with Message()
+        """
+        if _tunnel is not None:
+            return _tunnel.recv_batch(sock.fileno(), self.buffers, self.lengths, self.addresses)
+
+        if _libc is None:
+            self.lengths[0], self.addresses[0] = sock.recvfrom_into(self.buffers[0])
+            return 1
+
+        # The kernel overwrites these on every call
+        for index in range(self.count):
+            self._vectors[index].iov_len = self._size
+            self._headers[index].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+
+        received = _libc.recvmmsg(sock.fileno(), ctypes.addressof(self._headers), self.count, socket.MSG_DONTWAIT, None)
+        if received < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise OSError(error, os.strerror(error))
+
+        for index in range(received):
+            self.lengths[index] = self._headers[index].msg_len
+            name = self._names[index]
+            self.addresses[index] = (socket.inet_ntoa(bytes(name.sin_addr)), socket.ntohs(name.sin_port))
+
+        return received
+
+    def Message(self, index):
+        """Returns a received datagram
+
+        Args:
+            index (int): Index of the datagram in the batch
+
+        Returns:
+            (memoryview, (IP, Port)): Datagram data and the address it came from
+        """
+        return self.views[index][:self.lengths[index]], self.addresses[index]
+
+    def NextBuffer(self):
+        """Returns the buffer to write the next datagram to send into
+
+        Returns:
+            bytearray: Free buffer of the batch
+        """
+        return self.buffers[self.pending]
+
+    def NextView(self):
+        """Returns a view of the buffer to write the next datagram to send into, for recv_into and such
+
+        Returns:
+            memoryview: View of the free buffer of the batch
+        """
+        return self.views[self.pending]
+
+    def Push(self, size, address):
+        """Queues the datagram written into NextBuffer() for sending
+
+        Args:
+            size (int): Size of the datagram in NextBuffer()
+            address ((IP, Port)): Address to send the datagram to
+
+        Returns:
+            bool: True if the batch is full and must be flushed
+        """
+        self.lengths[self.pending] = size
+        self.addresses[self.pending] = address
+        self.pending += 1
+        return self.pending == self.count
+
+    def Flush(self, sock):
+        """Sends all queued datagrams
+
+        Args:
+            sock (socket): Socket to send the datagrams from
+        """
+        if self.pending == 0:
+            return
+
+        if _tunnel is not None:
+            try:
+                _tunnel.send_batch(sock.fileno(), self.buffers, self.lengths, self.addresses, self.pending, self._packedAddresses)
+            finally:
+                self._Clear()
+            return
+
+        if _libc is None:
+            for index in range(self.pending):
+                sock.sendto(self.views[index][:self.lengths[index]], self.addresses[index])
+            self._Clear()
+            return
+
+        for index in range(self.pending):
+            self._vectors[index].iov_len = self.lengths[index]
+            self._SetAddress(index, self.addresses[index])
+
+        # sendmmsg can send only part of the batch, send the rest after it
+        sent = 0
+        while sent < self.pending:
+            result = _libc.sendmmsg(sock.fileno(), ctypes.addressof(self._headers) + sent * ctypes.sizeof(_MMsgHdr), self.pending - sent, 0)
+            if result < 0:
+                error = ctypes.get_errno()
+                self._Clear()
+                raise OSError(error, os.strerror(error))
+            sent += result
+
+        self._Clear()
+
+    def Close(self):
+        """Nothing to stop, sending is done by Flush. Lets a MessageBatch be used in place of a SendThread
+        """
+
+    def _Clear(self):
+        """Empties the send queue
+        """
+        self.pending = 0
+
+    def _SetAddress(self, index, address):
+        """Writes a destination address into a message header
+
+        Args:
+            index (int): Index of the datagram in the batch
+            address ((IP, Port)): Destination address, the IP can be a host name
+        """
+        packed = self._packedAddresses.get(address[0])
+        if packed is None:
+            packed = socket.inet_aton(socket.gethostbyname(address[0]))
+            self._packedAddresses[address[0]] = packed
+
+        name = self._names[index]
+        name.sin_family = socket.AF_INET
+        name.sin_port = socket.htons(address[1])
+        name.sin_addr[:] = packed
+        self._headers[index].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+
+
+class SendThread(object):
+
+    """Sends batches of datagrams from a background thread
+
+    Has the sending side of MessageBatch (NextBuffer, NextView, Push, Flush),
+    but Flush only queues the filled batch for the thread and carries on
+    with a free one, so the caller keeps reading while the kernel sends.
+    Batches are sent in the order they were flushed.
+
+    Attributes:
+        batch (MessageBatch): Batch being filled by the caller
+        readySocket (socket): Gets a byte once a batch is free again after Backlogged() returned True
+    """
+
+    def __init__(self, count=BATCH_SIZE, size=65565, batches=SEND_THREAD_BATCHES):
+        """Allocates the batches and starts the sending thread
+
+        Args:
+            count (int, optional): Number of datagrams in each batch
+            size (int, optional): Maximum size of a single datagram
+            batches (int, optional): Number of batches, the caller waits when all of them are queued
+        """
+        self.batch = MessageBatch(count, size)
+        self._free = collections.deque(MessageBatch(count, size) for _ in range(batches - 1))
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._notify = False
+        self.readySocket, self._readyWriter = socket.socketpair()
+
+        self._thread = threading.Thread(target=self._Run, name="SendThread")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def NextBuffer(self):
+        """Returns the buffer to write the next datagram to send into
+
+        Returns:
+            bytearray: Free buffer of the batch
+        """
+        return self.batch.NextBuffer()
+
+    def NextView(self):
+        """Returns a view of the buffer to write the next datagram to send into, for recv_into and such
+
+        Returns:
+            memoryview: View of the free buffer of the batch
+        """
+        return self.batch.NextView()
+
+    def Push(self, size, address):
+        """Queues the datagram written into NextBuffer() for sending
+
+        Args:
+            size (int): Size of the datagram in NextBuffer()
+            address ((IP, Port)): Address to send the datagram to
+
+        Returns:
+            bool: True if the batch is full and must be flushed
+        """
+        return self.batch.Push(size, address)
+
+    def Flush(self, sock):
+        """Hands the queued datagrams to the sending thread and switches to a free batch
+
+        Args:
+            sock (socket): Socket to send the datagrams from
+        """
+        if self.batch.pending == 0:
+            return
+
+        with self._condition:
+            self._queue.append((self.batch, sock))
+            self._condition.notify_all()
+
+            # Every batch is waiting to be sent, the kernel is the bottleneck
+            while not self._free:
+                self._condition.wait()
+            self.batch = self._free.popleft()
+
+    def Backlogged(self):
+        """Checks if every other batch is waiting to be sent, so the next Flush would wait for the thread.
+        When it is, readySocket gets a byte once a batch is free again, the caller can stop filling until then
+
+        Returns:
+            bool: True if the next Flush would wait
+        """
+        with self._condition:
+            if self._free:
+                return False
+
+            self._notify = True
+            return True
+
+    def Close(self):
+        """Waits for the queued batches to be sent, stops the thread and closes readySocket
+        """
+        with self._condition:
+            self._queue.append((None, None))
+            self._condition.notify_all()
+
+        self._thread.join()
+        self.readySocket.close()
+        self._readyWriter.close()
+
+    def _Run(self):
+        """Sends the flushed batches until Close
+        """
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                batch, sock = self._queue.popleft()
+
+            if batch is None:
+                return
+
+            # Nobody to raise to, the datagrams are lost like any dropped ICMP packet
+            try:
+                batch.Flush(sock)
+            except OSError as x:
+                logger.Log("ERROR", "Failed sending ICMP packets: {}", x)
+
+            with self._condition:
+                self._free.append(batch)
+                self._condition.notify_all()
+                notify = self._notify
+                self._notify = False
+
+            if notify:
+                self._readyWriter.send(b"\0")
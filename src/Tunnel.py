@@ -3,47 +3,241 @@
 
 Attributes:
     ICMP_BUFFER_SIZE (int): Maximum ICMP packet size
-    TCP_BUFFER_SIZE (int): Maximum TCP packet size
+    ICMP_SOCKET_BUFFER_SIZE (int): Kernel receive buffer size of the ICMP socket
+    MAX_TCP_BUFFER_SIZE (int): Largest TCP read that still fits a single IP packet with the IP and ICMP headers
+    TCP_BUFFER_SIZE (int): Default maximum TCP data read at once, sent in a single ICMP packet.
+        Fits a 1500 byte Ethernet MTU with the IP and ICMP headers, so the packet isn't fragmented
+    TCP_SOCKET_BUFFER_SIZE (int): Kernel send and receive buffer size of the TCP sockets
 """
+import random
 import socket
-import select
-import Icmp
+import selectors
+import sys
+import threading
+from Icmp import IcmpPacket, ICMP_ECHO_REQUEST, ICMP_ECHO_REPLY
+import Mmsg
 from Logger import logger
 
-TCP_BUFFER_SIZE = 1024
+TCP_BUFFER_SIZE = 1500 - IcmpPacket.IP_HEADER_SIZE - IcmpPacket.ICMP_HEADER_SIZE
 ICMP_BUFFER_SIZE = 65565
+ICMP_SOCKET_BUFFER_SIZE = 1 << 20
+TCP_SOCKET_BUFFER_SIZE = 1 << 18
+MAX_TCP_BUFFER_SIZE = 0xFFFF - IcmpPacket.IP_HEADER_SIZE - IcmpPacket.ICMP_HEADER_SIZE
+
+class TunnelClosed(Exception):
+
+    """Raised by a socket handler when the tunnel is done and Run should stop
+    """
+
 
 class Tunnel(object):
 
     """General class for all tunnel objects that need to run
 
     Knows how to create a TCP and ICMP sockets
+
+    Attributes:
+        icmpSelector (selectors.BaseSelector): Selector of the ICMP socket, a separate one when it has a thread of its own
+        selector (selectors.BaseSelector): Waits on the registered sockets and holds their handlers
+        sendThread (bool): Send the ICMP packets from a background thread
+        tcpBufferSize (int): Maximum TCP data read at once, each read is sent as one ICMP packet
+        tcpLock (threading.Lock): Held while reading a TCP socket, so the ICMP thread doesn't close it meanwhile
+        tcpReads (int): Maximum TCP reads each time a TCP socket has data
+        _icmpError (Exception): Error that stopped the ICMP thread, raised again by Run
+        _pausedTcp (dict): Handler of each TCP socket that isn't read until ResumeTcp
+        _tcpPaused (bool): TCP reads are paused, sockets registered meanwhile wait for ResumeTcp too
+        _receiveBatch (Mmsg.MessageBatch): Buffers for incoming ICMP packets
+        _sendBatch (Mmsg.MessageBatch): Buffers for outgoing ICMP packets, flushed once per Run round
+        _wakeReader (socket): Registered in both selectors, readable once the tunnel stops
+        _wakeWriter (socket): Written to stop both loops
     """
 
+    def __init__(self, drain=True, tcpBufferSize=TCP_BUFFER_SIZE, sendThread=False, icmpThread=False):
+        """Creates the selector, epoll on Linux, that keeps the sockets registered across Run rounds
+
+        Args:
+            drain (bool, optional): Read all the waiting TCP data (up to a send batch) on each wakeup instead of a single read
+            tcpBufferSize (int, optional): Maximum TCP data read at once, 1 to MAX_TCP_BUFFER_SIZE. Packets bigger than
+                the path MTU are fragmented by IP, use the MTU minus 38 (IP and ICMP headers) to avoid it
+            sendThread (bool, optional): Send the ICMP packets from a background thread while reading the next ones
+            icmpThread (bool, optional): Handle the ICMP socket (ICMP to TCP) on a thread of its own,
+                while Run handles the TCP sockets (TCP to ICMP)
+
+        Raises:
+            ValueError: tcpBufferSize is out of range
+        """
+        self.CheckTcpBufferSize(tcpBufferSize)
+
+        self.selector = selectors.DefaultSelector()
+        self.tcpReads = Mmsg.BATCH_SIZE if drain else 1
+        self.tcpBufferSize = tcpBufferSize
+        self.sendThread = sendThread
+        self.tcpLock = threading.Lock()
+        self.icmpSelector = self.selector
+        self._icmpError = None
+        self._pausedTcp = {}
+        self._tcpPaused = False
+        self._wakeReader = None
+        self._wakeWriter = None
+
+        if icmpThread:
+            self.icmpSelector = selectors.DefaultSelector()
+
+            # Never read, so once written both loops see it
+            self._wakeReader, self._wakeWriter = socket.socketpair()
+            self.RegisterSocket(self._wakeReader, self._HandleWakeup)
+            self.RegisterSocket(self._wakeReader, self._HandleWakeup, self.icmpSelector)
+
+        # Packets are received and sent in batches, one syscall for several packets
+        self._receiveBatch = Mmsg.MessageBatch(Mmsg.BATCH_SIZE, ICMP_BUFFER_SIZE)
+        self._sendBatch = self.CreateSendBatch()
+
+    @staticmethod
+    def CheckTcpBufferSize(tcpBufferSize):
+        """Checks the TCP buffer size, subclasses call it before opening any socket
+
+        Args:
+            tcpBufferSize (int): Maximum TCP data read at once
+
+        Raises:
+            ValueError: tcpBufferSize isn't between 1 and MAX_TCP_BUFFER_SIZE
+        """
+        # An empty read means the connection closed, and a bigger read doesn't fit an IP packet
+        if not 1 <= tcpBufferSize <= MAX_TCP_BUFFER_SIZE:
+            raise ValueError("TCP buffer size must be between 1 and {}".format(MAX_TCP_BUFFER_SIZE))
+
+    def CreateSendBatch(self):
+        """Creates the batch outgoing ICMP packets are queued in, sent by a background thread if sendThread is set
+
+        Returns:
+            Mmsg.MessageBatch: Batch to queue packets in, a Mmsg.SendThread when sending from a thread
+        """
+        size = IcmpPacket.ICMP_HEADER_SIZE + self.tcpBufferSize
+        if self.sendThread:
+            sendBatch = Mmsg.SendThread(Mmsg.BATCH_SIZE, size)
+            self.RegisterSocket(sendBatch.readySocket, self._HandleSendReady)
+            return sendBatch
+
+        return Mmsg.MessageBatch(Mmsg.BATCH_SIZE, size)
+
+    def RegisterSocket(self, sock, handler, selector=None):
+        """Start waiting for data on a socket
+
+        Args:
+            sock (socket): Socket to wait on
+            handler (function): Called with the socket when it has data to read
+            selector (selectors.BaseSelector, optional): Selector to wait with, the TCP one by default
+        """
+        (selector or self.selector).register(sock, selectors.EVENT_READ, handler)
+
+    def UnregisterSocket(self, sock, selector=None):
+        """Stop waiting for data on a socket, must be called before closing it
+
+        Args:
+            sock (socket): Socket to stop waiting on
+            selector (selectors.BaseSelector, optional): Selector it was registered with, the TCP one by default
+        """
+        # A paused socket is only waiting to be registered again
+        if self._pausedTcp.pop(sock, None) is not None:
+            return
+
+        (selector or self.selector).unregister(sock)
+
+    def RegisterTcpSocket(self, sock):
+        """Start reading a TCP socket with HandleTcp. The caller must hold tcpLock, so the ICMP thread
+        doesn't change the selector while PauseTcp goes over it
+
+        Args:
+            sock (socket): TCP socket to read
+        """
+        if self._tcpPaused:
+            self._pausedTcp[sock] = self.HandleTcp
+        else:
+            self.RegisterSocket(sock, self.HandleTcp)
+
+    def PauseTcp(self):
+        """Stops reading the TCP sockets until ResumeTcp, the ICMP socket is still handled meanwhile
+        """
+        with self.tcpLock:
+            self._tcpPaused = True
+            for key in list(self.selector.get_map().values()):
+                if key.data == self.HandleTcp:
+                    self._pausedTcp[key.fileobj] = key.data
+                    self.selector.unregister(key.fileobj)
+
+        logger.Log("DEBUG", "Paused reading TCP, {} sockets", len(self._pausedTcp))
+
+    def ResumeTcp(self):
+        """Reads the TCP sockets paused by PauseTcp again
+        """
+        with self.tcpLock:
+            self._tcpPaused = False
+            for sock, handler in self._pausedTcp.items():
+                self.selector.register(sock, selectors.EVENT_READ, handler)
+            self._pausedTcp.clear()
+
+    def CloseSelectors(self):
+        """Closes the selectors, and the sockets waking them, once the tunnel is done
+        """
+        if self.icmpSelector is not self.selector:
+            self.icmpSelector.close()
+            self._wakeReader.close()
+            self._wakeWriter.close()
+
+        self.selector.close()
+
     @staticmethod
-    def CreateIcmpSocket():
-        """Create a Raw ICMP socket for sending and receiving
+    def CreateIcmpSocket(unprivileged=False):
+        """Create an ICMP socket for sending and receiving
+
+        Args:
+            unprivileged (bool, optional): On Linux, try an unprivileged (SOCK_DGRAM) ICMP socket first, falling back to a
+                raw one when net.ipv4.ping_group_range doesn't allow it. It receives only the ICMP packet, without the IP header,
+                and only echo replies to its own id, which the kernel sets on every packet sent. Other systems
+                (macOS) keep the IP header and don't assign an id, so they always get a raw socket
 
         Returns:
-            socket: Raw ICMP socket
+            socket: ICMP socket, check its type to know which one it is
         """
         # Doesn't handle errors, calling function should
+        sock = None
+        if unprivileged and sys.platform.startswith("linux"):
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            except PermissionError:
+                logger.Log("DEBUG", "Unprivileged ICMP sockets aren't allowed, using a raw one")
+
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+
         logger.Log("DEBUG", "ICMP socket created")
-        return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+
+        # Draining TCP sends the packets in bursts, give the receiver room for them.
+        # The kernel caps this at net.core.rmem_max
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ICMP_SOCKET_BUFFER_SIZE)
+        return sock
 
     @staticmethod
-    def CreateTcpSocket(dst, server=False):
+    def CreateTcpSocket(dst, server=False, tune=True):
         """Create a TCP socket with given destination. Binds/Connects to ip depending on params
 
         Args:
             dst ((IP, Port)): Destination to connect to
             server (bool, optional): If true we bind to dst instead of connecting
+            tune (bool, optional): Disable Nagle and set the socket buffers to TCP_SOCKET_BUFFER_SIZE
         """
-        logger.Log("DEBUG", "TCP socket created on {}.{}".format(dst[0], dst[1]))
+        logger.Log("DEBUG", "TCP socket created on {}.{}", dst[0], dst[1])
         # Create reusable socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        # The data arrives already chunked by ICMP packets, don't hold it back waiting for more.
+        # Set before connecting/listening so the window scale fits the buffers, accepted sockets inherit them
+        if tune:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TCP_SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_SOCKET_BUFFER_SIZE)
+
         # If we are a server then bind, else connect to to destination
         if server:
             sock.bind(dst)
@@ -52,98 +246,314 @@ class Tunnel(object):
 
         return sock
 
+    def HandleIcmp(self, sock):
+        """Handle received ICMP packets.
+        Reads all the waiting ICMP packets and handles each of them with HandleIcmpPacket.
+
+        Args:
+            sock (socket): ICMP socket that has data to read from
+        """
+        message = self._receiveBatch.Message
+        handleIcmpPacket = self.HandleIcmpPacket
+        for index in range(self._receiveBatch.Receive(sock)):
+            handleIcmpPacket(*message(index))
+
+    def HandleTcp(self, sock):
+        """Handle data from a TCP connection.
+        Reads the waiting data in chunks straight into the send batch and forwards each of them with ForwardTcp.
+
+        Args:
+            sock (socket): Socket that we got the data from
+        """
+        # Looked up once instead of on every read
+        nextView = self._sendBatch.NextView
+        recvInto = sock.recv_into
+        forwardTcp = self.ForwardTcp
+        headerSize = IcmpPacket.ICMP_HEADER_SIZE
+        bufferSize = self.tcpBufferSize
+
+        with self.tcpLock:
+            # The ICMP thread may have closed the socket since it was selected
+            if sock.fileno() == -1:
+                return
+
+            flags = 0
+            for _ in range(self.tcpReads):
+                # Receive right after the room for the ICMP header, so the packet is sent from there as is
+                view = nextView()
+                try:
+                    size = recvInto(view[headerSize:], bufferSize, flags)
+                except BlockingIOError:
+                    return
+                except OSError as x:
+                    # A reset connection is closed as well, forward it like an empty read
+                    logger.Log("INFO", "TCP connection lost: {}", x)
+                    size = 0
+
+                forwardTcp(sock, view[headerSize:headerSize + size])
+
+                # Connection closed
+                if size == 0:
+                    return
+
+                # Only the first read is sure to have data, don't block on the rest.
+                # The socket itself stays blocking so sends are never partial
+                flags = socket.MSG_DONTWAIT
+
     def Run(self):
-        """Run on sockets on we receive data on one
+        """Run on sockets on we receive data on one.
+        With icmpThread the ICMP socket is handled by a thread of its own meanwhile
+        """
+        if self.icmpSelector is self.selector:
+            self._RunSelector(self.selector, self._sendBatch)
+            return
+
+        thread = threading.Thread(target=self._RunIcmpThread, name="IcmpThread")
+        thread.daemon = True
+        thread.start()
+
+        try:
+            self._RunSelector(self.selector, self._sendBatch)
+        finally:
+            # Stop the ICMP thread as well
+            self._wakeWriter.send(b"\0")
+            thread.join()
+
+    def _RunSelector(self, selector, sendBatch=None):
+        """Waits on the sockets of a selector and calls their handlers, until one of them raises
+
+        Args:
+            selector (selectors.BaseSelector): Selector to wait with
+            sendBatch (Mmsg.MessageBatch, optional): Flushed after each round, None if the handlers don't send ICMP packets
         """
+        # Looked up once instead of on every round
+        select = selector.select
+        flush = sendBatch.Flush if sendBatch is not None else None
+        backlogged = sendBatch.Backlogged if sendBatch is not None and self.sendThread else None
+        icmpSocket = self.icmpSocket
+
         while True:
-            socketsRead, _, _ = select.select(self.sockets, [], [])
-            for sock in socketsRead:
-                if sock.proto == socket.IPPROTO_ICMP:
-                    self.HandleIcmp(sock)
-                else:
-                    self.HandleTcp(sock)
+            for key, _ in select():
+                # A handler earlier in this round may have unregistered and closed the socket
+                sock = key.fileobj
+                if sock.fileno() != -1:
+                    key.data(sock)
+
+            # Send the packets queued while handling this round in one go
+            if flush is not None:
+                flush(icmpSocket)
+
+                # Every batch is waiting for the send thread. Stop reading TCP until one is free,
+                # instead of waiting for it on the next flush and leaving the ICMP socket unread
+                if backlogged is not None and backlogged():
+                    self.PauseTcp()
+
+    def _RunIcmpThread(self):
+        """Handles the ICMP socket until the tunnel stops, an error is passed on to the Run thread
+        """
+        try:
+            self._RunSelector(self.icmpSelector)
+        except TunnelClosed:
+            pass
+        except Exception as x:
+            self._icmpError = x
+
+        # Stops the Run thread too, when an ICMP handler is the one that closed the tunnel
+        self._wakeWriter.send(b"\0")
+
+    def _HandleSendReady(self, sock):
+        """Resumes reading TCP once the send thread has a free batch again
+
+        Args:
+            sock (socket): The send thread's ready socket
+        """
+        sock.recv(64)
+        self.ResumeTcp()
+
+    def _HandleWakeup(self, sock):
+        """Stops the loop that was woken up
+
+        Args:
+            sock (socket): The wake up socket
+        """
+        if self._icmpError is not None:
+            raise self._icmpError
+
+        raise TunnelClosed()
 
 class Server(Tunnel):
 
     """ICMP Tunnel Server.
 
-    Waits for ICMP packets, parses them and passes them forward as TCP
+    Waits for ICMP packets, parses them and passes them forward as TCP.
+    Serves many clients at once, each client is told apart by its IP and the ICMP id of its packets
 
     Attributes:
-        dst ((IP, Port)): Destination of pc we have a TCP connection with. This is the TCP server data
         icmpSocket (socket): Socket that receives and sends the ICMP data
-        sockets (list): List of sockets to wait for data for them
-        src ((Ip, Port)): Destination of pc that is initializing the TCP connection over the tunnel
-        tcpSocket (socket): Socket that is connected to the destination TCP
+        _clientKeys (dict): Client key of each TCP socket file descriptor
+        _clients (dict): (TCP socket, dst (IP, Port), dst IP packed with inet_aton) of each (client IP, ICMP id)
+        _packetHandlers (dict): Handler of each client packet (type, code), other packets are ignored
     """
 
-    def __init__(self):
+    def __init__(self, drain=True, tcpBufferSize=TCP_BUFFER_SIZE, sendThread=False, icmpThread=False):
         """Creates an ICMP Socket that will wait for a packet from the client on Run
-        """
-        self.src = None
-        self.dst = None
-        self.tcpSocket = None
-        self.icmpSocket = Tunnel.CreateIcmpSocket()
-        self.sockets = [self.icmpSocket]
-
-    def HandleIcmp(self, socket):
-        """Handle a received ICMP packet (from the client).
-        Reads the ICMP packet and forwards the payload as a TCP packet to the TCP server.
 
         Args:
-            socket (socket): ICMP socket that has data to read from
+            drain (bool, optional): Read all the waiting TCP data on each wakeup instead of a single read
+            tcpBufferSize (int, optional): Maximum TCP data sent in a single ICMP packet
+            sendThread (bool, optional): Send the ICMP packets from a background thread
+            icmpThread (bool, optional): Handle the ICMP socket on a thread of its own
+
+        Raises:
+            ValueError: tcpBufferSize is out of range
         """
-        # Read and parse data
-        packet, address = socket.recvfrom(ICMP_BUFFER_SIZE)
+        self.CheckTcpBufferSize(tcpBufferSize)
+        self._clients = {}
+        self._clientKeys = {}
+        self.icmpSocket = Tunnel.CreateIcmpSocket()
 
-        try:
-            packet = Icmp.IcmpPacket.Parse(packet)
-        except Exception as x:
-            logger.Log("DEBUG", "Failed parsing packet")
-            return
+        super(Server, self).__init__(drain, tcpBufferSize, sendThread, icmpThread)
+        self.RegisterSocket(self.icmpSocket, self.HandleIcmp, self.icmpSelector)
+
+        # One lookup per packet instead of comparing the type and code against each case.
+        # Our own replies are echoed back to the raw socket too, they have no handler
+        self._packetHandlers = {
+            (ICMP_ECHO_REQUEST, 0): self._HandleData,
+            (ICMP_ECHO_REQUEST, 1): self._HandleClose,
+        }
 
-        self.src = address[0]
-        self.dst = packet.dst
+    def HandleIcmpPacket(self, data, address):
+        """Handle a single received ICMP packet (from the client).
+        Parses the ICMP packet and forwards the payload as a TCP packet to the TCP server.
 
+        Args:
+            data (memoryview): Received ICMP packet
+            address ((IP, Port)): Address the packet came from
+        """
         # If this is not an IcmpTunnelPacket ignore it
-        if packet.magic != Icmp.IcmpPacket.MAGIC:
+        packet = IcmpPacket.TryParse(data)
+        if packet is None:
             return
 
-        # Skip our packets
-        if packet.type == Icmp.ICMP_ECHO_REPLY and packet.code == 0:
-            logger.Log("DEBUG", "Failed parsing packet")
+        handler = self._packetHandlers.get((packet.type, packet.code))
+        if handler is None:
+            if __debug__ and logger.IsEnabledFor("DEBUG"):
+                logger.Log("DEBUG", "Skipping ICMP packet type {} code {}", packet.type, packet.code)
             return
 
-        # Close requested
-        if packet.type == Icmp.ICMP_ECHO_REQUEST and packet.code == 1:
-            self.sockets.remove(self.tcpSocket)
-            self.tcpSocket.close()
-            self.tcpSocket = None
-            logger.Log("INFO", "Client closed")
+        handler(packet, (address[0], packet.id))
+
+    def _HandleData(self, packet, key):
+        """Forwards the payload of a client packet to the TCP server, connecting to it on the first packet
+
+        Args:
+            packet (IcmpPacket): Parsed client packet
+            key ((IP, int)): Client IP and ICMP id
+        """
+        # Clients on unprivileged ICMP sockets can only send code 0, they close with an empty packet
+        if len(packet.payload) == 0:
+            self._HandleClose(packet, key)
             return
 
         # Create socket if it doesnt exist
-        if not self.tcpSocket:
-            self.tcpSocket = self.CreateTcpSocket(self.dst)
-            self.sockets.append(self.tcpSocket)
-            logger.Log("INFO", "Client joined")
+        client = self._clients.get(key)
+        if client is None:
+            try:
+                tcpSocket = self.CreateTcpSocket(packet.dst)
+            except OSError as x:
+                # Only this client fails, the server keeps serving the others
+                logger.Log("INFO", "Client {} couldn't connect to {}: {}", key, packet.dst, x)
+                self._SendClose(key, packet.dst, packet.dstPacked)
+                return
+
+            client = (tcpSocket, packet.dst, packet.dstPacked)
+            with self.tcpLock:
+                self._clients[key] = client
+                self._clientKeys[tcpSocket.fileno()] = key
+                self.RegisterTcpSocket(tcpSocket)
+            logger.Log("INFO", "Client {} joined", key)
 
         # Send the packet
-        self.tcpSocket.send(packet.payload)
+        try:
+            client[0].send(packet.payload)
+        except OSError as x:
+            # The TCP server closed the connection, with icmpThread maybe just now on the other thread
+            logger.Log("INFO", "Client {} lost its TCP connection: {}", key, x)
+            with self.tcpLock:
+                removed = self._RemoveClient(key)
 
-    def HandleTcp(self, sock):
-        """Handle a packet from the TCP connection.
-        Reads the packet and forwards it over ICMP to the client ICMP tunnel.
+            if removed:
+                self._SendClose(key, client[1], client[2])
+
+    def _HandleClose(self, packet, key):
+        """Closes the connection to the TCP server when the client closed its side
 
         Args:
-            sock (socket): Socket that we got the data from
+            packet (IcmpPacket): Parsed client packet
+            key ((IP, int)): Client IP and ICMP id
+        """
+        with self.tcpLock:
+            removed = self._RemoveClient(key)
+
+        # A repeated close finds nothing left to clean up
+        if removed:
+            logger.Log("INFO", "Client {} closed", key)
+
+    def _SendClose(self, key, dst, dstPacked):
+        """Tells a client its TCP connection closed. Sent right away rather than queued,
+        the send batch belongs to the Run thread when the ICMP socket has a thread of its own
+
+        Args:
+            key ((IP, int)): Client IP and ICMP id
+            dst ((IP, Port)): Destination of the client's TCP connection
+            dstPacked (bytes): dst IP packed with inet_aton
         """
-        # Read tcp data
-        data = sock.recv(TCP_BUFFER_SIZE)
+        packet = IcmpPacket(ICMP_ECHO_REPLY, 1, 0, key[1], 0, b"", None, dst, dstPacked=dstPacked)
+        self.icmpSocket.sendto(packet.Create(), (key[0], 0))
 
-        # Wrap the data with an ICMP packet and send it to the client
-        packet = Icmp.IcmpPacket(Icmp.ICMP_ECHO_REPLY, 0, 0, 0, 0, data, self.src, self.dst)
-        self.icmpSocket.sendto(packet.Create(), (self.src, 0))
+    def _RemoveClient(self, key):
+        """Forgets a client, unregistering and closing its TCP socket. The caller must hold tcpLock,
+        so HandleTcp never sees a socket that is registered without its client
+
+        Args:
+            key ((IP, int)): Client IP and ICMP id
+
+        Returns:
+            bool: False if the client was already removed
+        """
+        client = self._clients.pop(key, None)
+        if client is None:
+            return False
+
+        tcpSocket = client[0]
+        del self._clientKeys[tcpSocket.fileno()]
+        self.UnregisterSocket(tcpSocket)
+        tcpSocket.close()
+        return True
+
+    def ForwardTcp(self, sock, data):
+        """Forwards data read from a TCP connection over ICMP to the client ICMP tunnel it belongs to.
+
+        Args:
+            sock (socket): TCP socket the data was read from
+            data (memoryview): Data read from the TCP connection, placed right after the header room of the next send buffer.
+                Empty if the TCP server closed the connection
+        """
+        key = self._clientKeys[sock.fileno()]
+        _, dst, dstPacked = self._clients[key]
+
+        # Wrap the data with an ICMP header carrying the client's id and send it to the client.
+        # An empty packet with code 1 tells the client the TCP server closed, after the data queued before it
+        code = 0 if len(data) > 0 else 1
+        size = IcmpPacket.ICMP_HEADER_SIZE + len(data)
+        IcmpPacket.WriteHeader(self._sendBatch.NextBuffer(), size, ICMP_ECHO_REPLY, code, dstPacked, dst[1], key[1])
+        if self._sendBatch.Push(size, (key[0], 0)):
+            self._sendBatch.Flush(self.icmpSocket)
+
+        # Called by HandleTcp, which already holds tcpLock
+        if code == 1:
+            self._RemoveClient(key)
+            logger.Log("INFO", "Client {} closed by the TCP server", key)
 
 
 class Client(Tunnel):
@@ -153,68 +563,145 @@ class Client(Tunnel):
     Attributes:
         dst ((IP, Port)): Destination of the server TCP
         icmpSocket (socket): Socket that receives and sends the ICMP data
+        id (int): ICMP id of our packets, the server tells its clients apart by it and replies with it
+        _closeCode (int): ICMP code of the packet telling the server we closed, unprivileged sockets can only send 0
+        _ipHeader (bool): Received packets start with an IP header, only on a raw ICMP socket
+        _serverClosed (bool): The server's TCP connection is closed, it told us or we told it
         proxy (string): IP address of the ICMP tunnel server
-        sockets (list): List of sockets to wait for data for them
         tcpSocket (socket): Socket that is connected to the destination TCP
+        _dstPacked (bytes): dst IP packed with inet_aton once for all packets
     """
 
-    def __init__(self, proxy, sock, dst):
+    def __init__(self, proxy, sock, dst, drain=True, tcpBufferSize=TCP_BUFFER_SIZE, sendThread=False, icmpThread=False):
         """Creates a ICMP tunnel client that connects to the ICMP tunnel server and sends its tcp there.
 
         Args:
             proxy (string): IP address of the ICMP tunnel server
             sock (socket): The tcp socket that started the tunnel
             dst ((IP, Port)): Destination of the server TCP
+            drain (bool, optional): Read all the waiting TCP data on each wakeup instead of a single read
+            tcpBufferSize (int, optional): Maximum TCP data sent in a single ICMP packet
+            sendThread (bool, optional): Send the ICMP packets from a background thread
+            icmpThread (bool, optional): Handle the ICMP socket on a thread of its own
+
+        Raises:
+            ValueError: tcpBufferSize is out of range
         """
+        self.CheckTcpBufferSize(tcpBufferSize)
         self.proxy = proxy
         self.tcpSocket = sock
         self.dst = dst
-        self.icmpSocket = self.CreateIcmpSocket()
-        self.sockets = [self.tcpSocket, self.icmpSocket]
-
-    def HandleIcmp(self, sock):
-        """Handle a received ICMP packet (from the server).
-        Reads the ICMP packet and forwards the payload as a TCP packet to the TCP client.
+        self.id = random.getrandbits(16)
+        self._dstPacked = socket.inet_aton(dst[0])
+        self.icmpSocket = self.CreateIcmpSocket(unprivileged=True)
+        self._ipHeader = self.icmpSocket.type == socket.SOCK_RAW
+        self._closeCode = 1
+        self._serverClosed = False
+
+        # The kernel picks the id of an unprivileged socket and only gives it the replies to that id
+        if not self._ipHeader:
+            self.icmpSocket.bind(("0.0.0.0", 0))
+            self.id = self.icmpSocket.getsockname()[1]
+            self._closeCode = 0
+
+        super(Client, self).__init__(drain, tcpBufferSize, sendThread, icmpThread)
+        with self.tcpLock:
+            self.RegisterTcpSocket(self.tcpSocket)
+        self.RegisterSocket(self.icmpSocket, self.HandleIcmp, self.icmpSelector)
+
+    def HandleIcmpPacket(self, data, address):
+        """Handle a single received ICMP packet (from the server).
+        Parses the ICMP packet and forwards the payload as a TCP packet to the TCP client.
 
         Args:
-            sock (socket): Our socket that received the ICMP data
+            data (memoryview): Received ICMP packet
+            address ((IP, Port)): Address the packet came from
         """
-
-        # Get the data and try to parse it
-        data, _ = sock.recvfrom(ICMP_BUFFER_SIZE)
-
-        try:
-            packet = Icmp.IcmpPacket.Parse(data)
-        except:
-            # Might not be our packet so the parsing will fail
+        # If this is not an IcmpTunnelPacket ignore it
+        packet = IcmpPacket.TryParse(data, self._ipHeader)
+        if packet is None:
             return
 
-        # If this is not an IcmpTunnelPacket ignore it
-        if packet.magic != Icmp.IcmpPacket.MAGIC:
+        # We send ICMP echo requests so ignore them, and replies to other clients
+        if packet.type == ICMP_ECHO_REQUEST or packet.id != self.id:
             return
 
-        # We send ICMP echo requests so ignore them
-        if packet.type != Icmp.ICMP_ECHO_REQUEST:
+        # The server's TCP connection closed, pass the close on to our TCP client
+        if packet.code == 1:
+            logger.Log("INFO", "Connection closed by the server")
+            self._serverClosed = True
+            try:
+                self.tcpSocket.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            raise TunnelClosed()
+
+        # Our TCP client is gone, Close tells the server
+        try:
             self.tcpSocket.send(packet.payload)
+        except OSError as x:
+            logger.Log("INFO", "TCP connection lost: {}", x)
+            raise TunnelClosed()
 
-    def HandleTcp(self, sock):
-        """Handle a packet from the TCP connection.
-        Reads the packet and forwards it over ICMP to the server ICMP tunnel.
+    def ForwardTcp(self, sock, data):
+        """Forwards data read from the TCP connection over ICMP to the server ICMP tunnel.
 
         Args:
-            sock (socket): Socket that we got the data from
+            sock (socket): TCP socket the data was read from
+            data (memoryview): Data read from the TCP connection, placed right after the header room of the next send buffer.
+                Empty if the connection was closed
         """
-        data = sock.recv(TCP_BUFFER_SIZE)
+        # Connection closed, no data, Close tells the server.
+        # With icmpThread the server may have closed just now, it would take more data for a new connection
+        if len(data) == 0 or self._serverClosed:
+            raise TunnelClosed()
 
-        # Build a ICMP packet with our TCP packet as the payload and send it to the server
-        code = 0 if len(data) > 0 else 1
-        packet = Icmp.IcmpPacket(Icmp.ICMP_ECHO_REQUEST, code, 0, 0, 0, data, self.tcpSocket.getsockname(), self.dst)
-        self.icmpSocket.sendto(packet.Create(), (self.proxy, 1))
+        # Put an ICMP header in front of our TCP packet and send it to the server
+        size = IcmpPacket.ICMP_HEADER_SIZE + len(data)
+        IcmpPacket.WriteHeader(self._sendBatch.NextBuffer(), size, ICMP_ECHO_REQUEST, 0, self._dstPacked, self.dst[1], self.id)
+        if self._sendBatch.Push(size, (self.proxy, 1)):
+            self._sendBatch.Flush(self.icmpSocket)
 
-        # Connection closed, no data
-        if code == 1:
+    def Run(self):
+        """Runs the tunnel until the TCP connection is closed, then releases its sockets
+        """
+        try:
+            super(Client, self).Run()
+        except TunnelClosed:
             logger.Log("INFO", "Connection closed")
-            exit()
+        finally:
+            self.Close()
+
+    def Close(self):
+        """Tells the server the connection closed, unless it closed first, then unregisters and closes the tunnel sockets
+        """
+        # However the tunnel stopped, the server mustn't keep its TCP connection open
+        if not self._serverClosed:
+            try:
+                self._SendClose()
+            except OSError as x:
+                logger.Log("ERROR", "Failed telling the server the connection closed: {}", x)
+
+        # Let the sending thread finish with the ICMP socket first
+        if self.sendThread:
+            self.UnregisterSocket(self._sendBatch.readySocket)
+        self._sendBatch.Close()
+
+        self.UnregisterSocket(self.tcpSocket)
+        self.tcpSocket.close()
+        self.UnregisterSocket(self.icmpSocket, self.icmpSelector)
+        self.icmpSocket.close()
+
+        self.CloseSelectors()
+
+    def _SendClose(self):
+        """Sends the server an empty packet with the close code, after the data queued before it
+        """
+        self._serverClosed = True
+        size = IcmpPacket.ICMP_HEADER_SIZE
+        IcmpPacket.WriteHeader(self._sendBatch.NextBuffer(), size, ICMP_ECHO_REQUEST, self._closeCode, self._dstPacked, self.dst[1], self.id)
+        self._sendBatch.Push(size, (self.proxy, 1))
+        self._sendBatch.Flush(self.icmpSocket)
 
 
 class ClientProxy(Tunnel):
@@ -225,10 +712,13 @@ class ClientProxy(Tunnel):
         dst ((IP, Port)): Destination of the TCP server we want to connect to
         local ((IP, Port)): Destination of the requesting TCP client
         proxy (string): IP of the ICMP tunnel server
+        icmpThread (bool): Each client handles its ICMP socket on a thread of its own
+        sendThread (bool): Each client sends its ICMP packets from a background thread
+        tcpBufferSize (int): Maximum TCP data sent in a single ICMP packet by each client
         tcpSocket (socket): Opened socket with the TCP client
     """
 
-    def __init__(self, proxy, localHost, localPort, dstHost, dstPort):
+    def __init__(self, proxy, localHost, localPort, dstHost, dstPort, tcpBufferSize=TCP_BUFFER_SIZE, sendThread=False, icmpThread=False):
         """Proxy of the Client Class. Creates a TCP connection and passes it to the client to handle the data
 
         Args:
@@ -237,22 +727,42 @@ class ClientProxy(Tunnel):
             localPort (int): Our TCP port to bind to
             dstHost (string): Server TCP IP that we want to connect to
             dstPort (int): Server TCP IP that we want to connect to
+            tcpBufferSize (int, optional): Maximum TCP data sent in a single ICMP packet by each client
+            sendThread (bool, optional): Each client sends its ICMP packets from a background thread
+            icmpThread (bool, optional): Each client handles its ICMP socket on a thread of its own
+
+        Raises:
+            ValueError: tcpBufferSize is out of range
         """
+        # Checked now rather than when the first connection is accepted
+        self.CheckTcpBufferSize(tcpBufferSize)
         self.proxy = proxy
         self.local = (localHost, localPort)
         self.dst = (dstHost, dstPort)
+        self.tcpBufferSize = tcpBufferSize
+        self.sendThread = sendThread
+        self.icmpThread = icmpThread
         self.tcpSocket = Tunnel.CreateTcpSocket(self.local, server=True)
 
     def Run(self):
         """Runs the proxy.
-        Waits for a TCP connection and passes it forward to the Client class to parse
+        Waits for TCP connections and passes each forward to the Client class to parse
         """
-        logger.Log("INFO", "Waiting for TCP connection")
         self.tcpSocket.listen(1)
-        sock, addr = self.tcpSocket.accept()
-        logger.Log("INFO", "Received TCP connection")
-        client = Client(self.proxy, sock, self.dst)
-        client.Run()
+
+        # Keep serving connections in the same process, one at a time
+        while True:
+            logger.Log("INFO", "Waiting for TCP connection")
+            sock, addr = self.tcpSocket.accept()
+            logger.Log("INFO", "Received TCP connection")
+
+            # One failed connection doesn't stop the proxy
+            try:
+                client = Client(self.proxy, sock, self.dst, tcpBufferSize=self.tcpBufferSize, sendThread=self.sendThread, icmpThread=self.icmpThread)
+                client.Run()
+            except OSError as x:
+                logger.Log("ERROR", "Connection failed: {}", x)
+                sock.close()
 
 
 
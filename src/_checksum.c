@@ -0,0 +1,56 @@
+/* Native ICMP checksum (RFC 1071)
+ *
+ * The sum itself is in checksum.h, shared with the _tunnel extension.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include "checksum.h"
+
+PyDoc_STRVAR(checksum_doc,
+"checksum(packet)\n\
+\n\
+Calculates a packet checksum.\n\
+\n\
+Args:\n\
+    packet (bytes-like): Array of bytes to calculates its checksum\n\
+\n\
+Returns:\n\
+    int: Calculated checksum, in network order");
+
+static PyObject *
+checksum(PyObject *self, PyObject *args)
+{
+    Py_buffer view;
+    uint16_t sum;
+
+    if (!PyArg_ParseTuple(args, "y*:checksum", &view)) {
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    sum = sum_words((const uint8_t *)view.buf, (size_t)view.len);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&view);
+    return PyLong_FromLong(finish(sum));
+}
+
+static PyMethodDef checksum_methods[] = {
+    {"checksum", checksum, METH_VARARGS, checksum_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef checksum_module = {
+    PyModuleDef_HEAD_INIT,
+    "_checksum",
+    "Native ICMP checksum",
+    -1,
+    checksum_methods
+};
+
+PyMODINIT_FUNC
+PyInit__checksum(void)
+{
+    checksum_init();
+    return PyModule_Create(&checksum_module);
+}
@@ -0,0 +1,445 @@
+/* Native per packet work of the tunnel
+ *
+ * Receives and sends whole batches of ICMP packets with recvmmsg/sendmmsg
+ * and writes ICMP headers in front of payloads already in the send buffer.
+ * The Python classes keep all the state (sockets, buffers, addresses) and
+ * hand it over on each call, so the tunnel works the same without this
+ * extension, only with more interpreter work per packet.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <errno.h>
+#include <arpa/inet.h>
+#include <netinet/in.h>
+#include <sys/socket.h>
+#include "checksum.h"
+
+/* "!BBHHH4sHL": type, code, checksum, id, sequence, dst IP, dst port, magic */
+#define ICMP_HEADER_SIZE 18
+#define CHECKSUM_OFFSET 2
+
+/* Message headers and buffer views of one recvmmsg/sendmmsg call */
+typedef struct {
+    Py_ssize_t count;
+    struct mmsghdr *messages;
+    struct iovec *vectors;
+    struct sockaddr_in *names;
+    Py_buffer *views;
+} batch_t;
+
+static int
+batch_alloc(batch_t *batch, Py_ssize_t count)
+{
+    batch->count = count;
+    batch->messages = PyMem_Calloc(count, sizeof(struct mmsghdr));
+    batch->vectors = PyMem_Calloc(count, sizeof(struct iovec));
+    batch->names = PyMem_Calloc(count, sizeof(struct sockaddr_in));
+    batch->views = PyMem_Calloc(count, sizeof(Py_buffer));
+
+    if (!batch->messages || !batch->vectors || !batch->names || !batch->views) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    return 0;
+}
+
+static void
+batch_free(batch_t *batch)
+{
+    Py_ssize_t index;
+
+    if (batch->views) {
+        /* Views that were never taken have no object and release as nothing */
+        for (index = 0; index < batch->count; index++) {
+            PyBuffer_Release(&batch->views[index]);
+        }
+    }
+
+    PyMem_Free(batch->messages);
+    PyMem_Free(batch->vectors);
+    PyMem_Free(batch->names);
+    PyMem_Free(batch->views);
+}
+
+/* Packs a host into sin_addr, caching the packed IP by host in cache */
+static int
+resolve(PyObject *host, PyObject *cache, struct in_addr *address)
+{
+    PyObject *packed;
+    PyObject *socketModule;
+    PyObject *ip;
+    const char *text;
+
+    packed = PyDict_GetItemWithError(cache, host);
+    if (packed == NULL) {
+        if (PyErr_Occurred()) {
+            return -1;
+        }
+
+        /* Host names are looked up once, like Mmsg does without this extension */
+        text = PyUnicode_AsUTF8(host);
+        if (text == NULL) {
+            return -1;
+        }
+        if (inet_pton(AF_INET, text, address) != 1) {
+            socketModule = PyImport_ImportModule("socket");
+            if (socketModule == NULL) {
+                return -1;
+            }
+            ip = PyObject_CallMethod(socketModule, "gethostbyname", "O", host);
+            Py_DECREF(socketModule);
+            if (ip == NULL) {
+                return -1;
+            }
+            text = PyUnicode_AsUTF8(ip);
+            if (text == NULL || inet_pton(AF_INET, text, address) != 1) {
+                Py_DECREF(ip);
+                if (!PyErr_Occurred()) {
+                    PyErr_SetString(PyExc_ValueError, "host didn't resolve to an IPv4 address");
+                }
+                return -1;
+            }
+            Py_DECREF(ip);
+        }
+
+        packed = PyBytes_FromStringAndSize((const char *)address, 4);
+        if (packed == NULL) {
+            return -1;
+        }
+        if (PyDict_SetItem(cache, host, packed) < 0) {
+            Py_DECREF(packed);
+            return -1;
+        }
+        Py_DECREF(packed);
+        return 0;
+    }
+
+    if (!PyBytes_Check(packed) || PyBytes_GET_SIZE(packed) != 4) {
+        PyErr_SetString(PyExc_ValueError, "cached address must be 4 packed bytes");
+        return -1;
+    }
+    memcpy(address, PyBytes_AS_STRING(packed), 4);
+    return 0;
+}
+
+PyDoc_STRVAR(recv_batch_doc,
+"recv_batch(fd, buffers, lengths, addresses)\n\
+\n\
+Receives as many waiting datagrams as there are buffers without blocking.\n\
+\n\
+Args:\n\
+    fd (int): Socket file descriptor\n\
+    buffers (list): Writable buffer for each datagram\n\
+    lengths (list): Filled with the length of each received datagram\n\
+    addresses (list): Filled with the (IP, Port) each datagram came from\n\
+\n\
+Returns:\n\
+    int: Number of datagrams received, 0 if none were waiting");
+
+static PyObject *
+recv_batch(PyObject *self, PyObject *args)
+{
+    int fd;
+    PyObject *buffers;
+    PyObject *lengths;
+    PyObject *addresses;
+    batch_t batch = {0};
+    Py_ssize_t count;
+    Py_ssize_t index;
+    int received;
+    int error;
+    char ip[INET_ADDRSTRLEN];
+
+    if (!PyArg_ParseTuple(args, "iO!O!O!:recv_batch", &fd, &PyList_Type, &buffers,
+                          &PyList_Type, &lengths, &PyList_Type, &addresses)) {
+        return NULL;
+    }
+
+    count = PyList_GET_SIZE(buffers);
+    if (PyList_GET_SIZE(lengths) < count || PyList_GET_SIZE(addresses) < count) {
+        PyErr_SetString(PyExc_ValueError, "lengths and addresses must have an item per buffer");
+        return NULL;
+    }
+    if (count == 0) {
+        return PyLong_FromLong(0);
+    }
+
+    if (batch_alloc(&batch, count) < 0) {
+        goto error;
+    }
+
+    for (index = 0; index < count; index++) {
+        struct msghdr *header = &batch.messages[index].msg_hdr;
+        Py_buffer *view = &batch.views[index];
+
+        if (PyObject_GetBuffer(PyList_GET_ITEM(buffers, index), view, PyBUF_WRITABLE) < 0) {
+            goto error;
+        }
+
+        batch.vectors[index].iov_base = view->buf;
+        batch.vectors[index].iov_len = (size_t)view->len;
+        header->msg_name = &batch.names[index];
+        header->msg_namelen = sizeof(struct sockaddr_in);
+        header->msg_iov = &batch.vectors[index];
+        header->msg_iovlen = 1;
+    }
+
+    do {
+        Py_BEGIN_ALLOW_THREADS
+        received = recvmmsg(fd, batch.messages, (unsigned int)count, MSG_DONTWAIT, NULL);
+        error = errno;
+        Py_END_ALLOW_THREADS
+    } while (received < 0 && error == EINTR && PyErr_CheckSignals() == 0);
+
+    if (received < 0) {
+        if (error == EAGAIN || error == EWOULDBLOCK) {
+            received = 0;
+        } else if (!PyErr_Occurred()) {
+            errno = error;
+            PyErr_SetFromErrno(PyExc_OSError);
+            goto error;
+        } else {
+            goto error;
+        }
+    }
+
+    for (index = 0; index < received; index++) {
+        struct sockaddr_in *name = &batch.names[index];
+        PyObject *length;
+        PyObject *address;
+
+        inet_ntop(AF_INET, &name->sin_addr, ip, sizeof(ip));
+        length = PyLong_FromUnsignedLong(batch.messages[index].msg_len);
+        address = Py_BuildValue("(si)", ip, (int)ntohs(name->sin_port));
+        if (length == NULL || address == NULL) {
+            Py_XDECREF(length);
+            Py_XDECREF(address);
+            goto error;
+        }
+
+        /* SetItem steals the references */
+        PyList_SetItem(lengths, index, length);
+        PyList_SetItem(addresses, index, address);
+    }
+
+    batch_free(&batch);
+    return PyLong_FromLong(received);
+
+error:
+    batch_free(&batch);
+    return NULL;
+}
+
+PyDoc_STRVAR(send_batch_doc,
+"send_batch(fd, buffers, lengths, addresses, count, cache)\n\
+\n\
+Sends the first count datagrams, with as few sendmmsg calls as the kernel allows.\n\
+\n\
+Args:\n\
+    fd (int): Socket file descriptor\n\
+    buffers (list): Buffer of each datagram\n\
+    lengths (list): Size of the datagram in each buffer\n\
+    addresses (list): (IP, Port) to send each datagram to, the IP can be a host name\n\
+    count (int): Number of datagrams to send\n\
+    cache (dict): Packed IP of each host, filled as hosts are resolved");
+
+static PyObject *
+send_batch(PyObject *self, PyObject *args)
+{
+    int fd;
+    PyObject *buffers;
+    PyObject *lengths;
+    PyObject *addresses;
+    PyObject *cache;
+    batch_t batch = {0};
+    Py_ssize_t count;
+    Py_ssize_t index;
+    Py_ssize_t sent;
+    int result;
+    int error;
+
+    if (!PyArg_ParseTuple(args, "iO!O!O!nO!:send_batch", &fd, &PyList_Type, &buffers,
+                          &PyList_Type, &lengths, &PyList_Type, &addresses,
+                          &count, &PyDict_Type, &cache)) {
+        return NULL;
+    }
+
+    if (count < 0 || PyList_GET_SIZE(buffers) < count || PyList_GET_SIZE(lengths) < count ||
+        PyList_GET_SIZE(addresses) < count) {
+        PyErr_SetString(PyExc_ValueError, "count is bigger than the batch");
+        return NULL;
+    }
+    if (count == 0) {
+        Py_RETURN_NONE;
+    }
+
+    if (batch_alloc(&batch, count) < 0) {
+        goto error;
+    }
+
+    for (index = 0; index < count; index++) {
+        struct msghdr *header = &batch.messages[index].msg_hdr;
+        struct sockaddr_in *name = &batch.names[index];
+        Py_buffer *view = &batch.views[index];
+        PyObject *address = PyList_GET_ITEM(addresses, index);
+        Py_ssize_t length;
+        long port;
+
+        if (PyObject_GetBuffer(PyList_GET_ITEM(buffers, index), view, PyBUF_SIMPLE) < 0) {
+            goto error;
+        }
+
+        length = PyLong_AsSsize_t(PyList_GET_ITEM(lengths, index));
+        if (length == -1 && PyErr_Occurred()) {
+            goto error;
+        }
+        if (length < 0 || length > view->len) {
+            PyErr_SetString(PyExc_ValueError, "datagram length is bigger than its buffer");
+            goto error;
+        }
+
+        batch.vectors[index].iov_base = view->buf;
+        batch.vectors[index].iov_len = (size_t)length;
+        header->msg_iov = &batch.vectors[index];
+        header->msg_iovlen = 1;
+
+        if (!PyTuple_Check(address) || PyTuple_GET_SIZE(address) != 2) {
+            PyErr_SetString(PyExc_TypeError, "address must be a (IP, Port) tuple");
+            goto error;
+        }
+        port = PyLong_AsLong(PyTuple_GET_ITEM(address, 1));
+        if (port == -1 && PyErr_Occurred()) {
+            goto error;
+        }
+        if (resolve(PyTuple_GET_ITEM(address, 0), cache, &name->sin_addr) < 0) {
+            goto error;
+        }
+        name->sin_family = AF_INET;
+        name->sin_port = htons((uint16_t)port);
+        header->msg_name = name;
+        header->msg_namelen = sizeof(struct sockaddr_in);
+    }
+
+    /* sendmmsg can send only part of the batch, send the rest after it */
+    sent = 0;
+    while (sent < count) {
+        Py_BEGIN_ALLOW_THREADS
+        result = sendmmsg(fd, batch.messages + sent, (unsigned int)(count - sent), 0);
+        error = errno;
+        Py_END_ALLOW_THREADS
+
+        if (result < 0) {
+            if (error == EINTR && PyErr_CheckSignals() == 0) {
+                continue;
+            }
+            if (!PyErr_Occurred()) {
+                errno = error;
+                PyErr_SetFromErrno(PyExc_OSError);
+            }
+            goto error;
+        }
+        sent += result;
+    }
+
+    batch_free(&batch);
+    Py_RETURN_NONE;
+
+error:
+    batch_free(&batch);
+    return NULL;
+}
+
+PyDoc_STRVAR(write_header_doc,
+"write_header(buffer, size, type, code, id, sequence, dst_packed, dst_port, magic)\n\
+\n\
+Writes an ICMP header at the start of buffer, in front of a payload that is\n\
+already in it, and checksums the header and payload in one pass.\n\
+\n\
+Args:\n\
+    buffer (bytearray): Buffer with the payload right after the header room\n\
+    size (int): Size of the whole packet, header included\n\
+    type (int): ICMP packet type\n\
+    code (int): ICMP packet code\n\
+    id (int): ICMP packet id\n\
+    sequence (int): ICMP packet sequence\n\
+    dst_packed (bytes): Destination IP packed with inet_aton\n\
+    dst_port (int): Destination port\n\
+    magic (int): Magic to validate its a tunnel packet\n\
+\n\
+Returns:\n\
+    int: Size of the header");
+
+static void
+put16(uint8_t *buf, unsigned int value)
+{
+    buf[0] = (uint8_t)(value >> 8);
+    buf[1] = (uint8_t)value;
+}
+
+static PyObject *
+write_header(PyObject *self, PyObject *args)
+{
+    Py_buffer view;
+    Py_ssize_t size;
+    unsigned char type;
+    unsigned char code;
+    unsigned short id;
+    unsigned short sequence;
+    const char *dstPacked;
+    Py_ssize_t dstPackedSize;
+    unsigned short dstPort;
+    unsigned int magic;
+    uint8_t *buf;
+    uint16_t checksum;
+
+    if (!PyArg_ParseTuple(args, "w*nBBHHy#HI:write_header", &view, &size, &type, &code,
+                          &id, &sequence, &dstPacked, &dstPackedSize, &dstPort, &magic)) {
+        return NULL;
+    }
+
+    if (size < ICMP_HEADER_SIZE || size > view.len || dstPackedSize != 4) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "size must fit the header and the buffer, dst_packed must be 4 bytes");
+        return NULL;
+    }
+
+    /* Zero checksum while summing, then patch it in */
+    buf = (uint8_t *)view.buf;
+    buf[0] = type;
+    buf[1] = code;
+    put16(buf + CHECKSUM_OFFSET, 0);
+    put16(buf + 4, id);
+    put16(buf + 6, sequence);
+    memcpy(buf + 8, dstPacked, 4);
+    put16(buf + 12, dstPort);
+    put16(buf + 14, magic >> 16);
+    put16(buf + 16, magic & 0xFFFF);
+
+    checksum = finish(sum_words(buf, (size_t)size));
+    put16(buf + CHECKSUM_OFFSET, checksum);
+
+    PyBuffer_Release(&view);
+    return PyLong_FromLong(ICMP_HEADER_SIZE);
+}
+
+static PyMethodDef tunnel_methods[] = {
+    {"recv_batch", recv_batch, METH_VARARGS, recv_batch_doc},
+    {"send_batch", send_batch, METH_VARARGS, send_batch_doc},
+    {"write_header", write_header, METH_VARARGS, write_header_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef tunnel_module = {
+    PyModuleDef_HEAD_INIT,
+    "_tunnel",
+    "Native per packet work of the tunnel",
+    -1,
+    tunnel_methods
+};
+
+PyMODINIT_FUNC
+PyInit__tunnel(void)
+{
+    checksum_init();
+    return PyModule_Create(&tunnel_module);
+}
@@ -0,0 +1,222 @@
+/* RFC 1071 one's complement sum, shared by the native extensions
+ *
+ * Sums the buffer 8 bytes at a time in native byte order and folds the
+ * result to 16 bits. The one's complement sum doesn't care about byte
+ * order, so on little endian hosts only the final result is swapped.
+ *
+ * On x86 buffers of SIMD_MIN_SIZE bytes and more are summed with AVX2 (or
+ * SSE2 when AVX2 is missing), picked at runtime by checksum_init(). Below
+ * that the vector setup and reduction cost more than the scalar loop.
+ */
+#ifndef ICMPTUNNEL_CHECKSUM_H
+#define ICMPTUNNEL_CHECKSUM_H
+
+#include <stdint.h>
+#include <string.h>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#include <immintrin.h>
+#define HAVE_X86_SIMD 1
+#endif
+
+#define SIMD_MIN_SIZE 256
+
+/* 32 bit lanes take up to 65535 16 bit words before they can overflow */
+#define SIMD_MAX_ROUNDS 0xFFFF
+
+/* Adds value to sum and returns the carry out */
+static inline uint64_t
+add_carry(uint64_t *sum, uint64_t value)
+{
+    return __builtin_add_overflow(*sum, value, sum);
+}
+
+static uint16_t
+fold(uint64_t sum)
+{
+    sum = (sum & 0xFFFFFFFF) + (sum >> 32);
+    sum = (sum & 0xFFFFFFFF) + (sum >> 32);
+    sum = (sum & 0xFFFF) + (sum >> 16);
+    sum = (sum & 0xFFFF) + (sum >> 16);
+    return (uint16_t)sum;
+}
+
+/* Returns the folded (not complemented) native order sum of the buffer */
+static uint16_t
+sum_scalar(const uint8_t *buf, size_t n)
+{
+    uint64_t acc[8] = {0};
+    uint64_t carry = 0;
+    uint64_t sum = 0;
+    uint64_t word;
+    size_t i;
+    int lane;
+
+    /* 64 bytes per iteration, one carry chain per accumulator */
+    while (n >= 64) {
+        for (lane = 0; lane < 8; lane++) {
+            memcpy(&word, buf + lane * 8, 8);
+            carry += add_carry(&acc[lane], word);
+        }
+        buf += 64;
+        n -= 64;
+    }
+
+    while (n >= 8) {
+        memcpy(&word, buf, 8);
+        carry += add_carry(&acc[0], word);
+        buf += 8;
+        n -= 8;
+    }
+
+    /* Zero padding the tail keeps the leftover bytes in their word position */
+    if (n > 0) {
+        word = 0;
+        memcpy(&word, buf, n);
+        carry += add_carry(&acc[0], word);
+    }
+
+    for (i = 0; i < 8; i++) {
+        carry += add_carry(&sum, acc[i]);
+    }
+
+    /* Adding the carries back can carry out again */
+    while (carry) {
+        carry = add_carry(&sum, carry);
+    }
+
+    return fold(sum);
+}
+
+#ifdef HAVE_X86_SIMD
+static int have_avx2;
+static int have_sse2;
+
+/* Returns the native order sum of n bytes, n must be a multiple of 64 */
+__attribute__((target("avx2")))
+static uint64_t
+sum_avx2(const uint8_t *buf, size_t n)
+{
+    const __m256i zero = _mm256_setzero_si256();
+    uint32_t lanes[8];
+    uint64_t sum = 0;
+    size_t rounds;
+    int lane;
+
+    while (n > 0) {
+        __m256i acc0 = zero, acc1 = zero, acc2 = zero, acc3 = zero;
+
+        /* Two load streams, each widened to 32 bit lanes in place so no
+         * cross lane shuffle is needed */
+        for (rounds = 0; rounds < SIMD_MAX_ROUNDS && n > 0; rounds++) {
+            __m256i a = _mm256_loadu_si256((const __m256i *)buf);
+            __m256i b = _mm256_loadu_si256((const __m256i *)(buf + 32));
+            acc0 = _mm256_add_epi32(acc0, _mm256_unpacklo_epi16(a, zero));
+            acc1 = _mm256_add_epi32(acc1, _mm256_unpackhi_epi16(a, zero));
+            acc2 = _mm256_add_epi32(acc2, _mm256_unpacklo_epi16(b, zero));
+            acc3 = _mm256_add_epi32(acc3, _mm256_unpackhi_epi16(b, zero));
+            buf += 64;
+            n -= 64;
+        }
+
+        _mm256_storeu_si256((__m256i *)lanes, acc0);
+        for (lane = 0; lane < 8; lane++) sum += lanes[lane];
+        _mm256_storeu_si256((__m256i *)lanes, acc1);
+        for (lane = 0; lane < 8; lane++) sum += lanes[lane];
+        _mm256_storeu_si256((__m256i *)lanes, acc2);
+        for (lane = 0; lane < 8; lane++) sum += lanes[lane];
+        _mm256_storeu_si256((__m256i *)lanes, acc3);
+        for (lane = 0; lane < 8; lane++) sum += lanes[lane];
+    }
+
+    return sum;
+}
+
+/* Returns the native order sum of n bytes, n must be a multiple of 32 */
+__attribute__((target("sse2")))
+static uint64_t
+sum_sse2(const uint8_t *buf, size_t n)
+{
+    const __m128i zero = _mm_setzero_si128();
+    uint32_t lanes[4];
+    uint64_t sum = 0;
+    size_t rounds;
+    int lane;
+
+    while (n > 0) {
+        __m128i acc0 = zero, acc1 = zero, acc2 = zero, acc3 = zero;
+
+        /* Widen to 32 bits instead of _mm_adds_epu16, a saturating add
+         * would lose the carries the checksum needs */
+        for (rounds = 0; rounds < SIMD_MAX_ROUNDS && n > 0; rounds++) {
+            __m128i a = _mm_loadu_si128((const __m128i *)buf);
+            __m128i b = _mm_loadu_si128((const __m128i *)(buf + 16));
+            acc0 = _mm_add_epi32(acc0, _mm_unpacklo_epi16(a, zero));
+            acc1 = _mm_add_epi32(acc1, _mm_unpackhi_epi16(a, zero));
+            acc2 = _mm_add_epi32(acc2, _mm_unpacklo_epi16(b, zero));
+            acc3 = _mm_add_epi32(acc3, _mm_unpackhi_epi16(b, zero));
+            buf += 32;
+            n -= 32;
+        }
+
+        _mm_storeu_si128((__m128i *)lanes, acc0);
+        for (lane = 0; lane < 4; lane++) sum += lanes[lane];
+        _mm_storeu_si128((__m128i *)lanes, acc1);
+        for (lane = 0; lane < 4; lane++) sum += lanes[lane];
+        _mm_storeu_si128((__m128i *)lanes, acc2);
+        for (lane = 0; lane < 4; lane++) sum += lanes[lane];
+        _mm_storeu_si128((__m128i *)lanes, acc3);
+        for (lane = 0; lane < 4; lane++) sum += lanes[lane];
+    }
+
+    return sum;
+}
+#endif
+
+/* Returns the folded (not complemented) native order sum of the buffer */
+static uint16_t
+sum_words(const uint8_t *buf, size_t n)
+{
+#ifdef HAVE_X86_SIMD
+    if (n >= SIMD_MIN_SIZE && (have_avx2 || have_sse2)) {
+        uint64_t sum;
+        size_t done;
+
+        if (have_avx2) {
+            done = n & ~(size_t)63;
+            sum = sum_avx2(buf, done);
+        } else {
+            done = n & ~(size_t)31;
+            sum = sum_sse2(buf, done);
+        }
+
+        /* The vector part ends on an even offset so the tail words line up */
+        return fold((uint64_t)fold(sum) + sum_scalar(buf + done, n - done));
+    }
+#endif
+    return sum_scalar(buf, n);
+}
+
+/* Detects the SIMD support, must be called before sum_words */
+static void
+checksum_init(void)
+{
+#ifdef HAVE_X86_SIMD
+    __builtin_cpu_init();
+    have_avx2 = __builtin_cpu_supports("avx2");
+    have_sse2 = __builtin_cpu_supports("sse2");
+#endif
+}
+
+/* Complements the sum, the result packs in network order as "!H" */
+static uint16_t
+finish(uint16_t sum)
+{
+    uint16_t answer = (uint16_t)~sum;
+#if __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+    answer = (uint16_t)((answer >> 8) | (answer << 8));
+#endif
+    return answer;
+}
+
+#endif
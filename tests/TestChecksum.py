@@ -0,0 +1,120 @@
+import os
+import random
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import Icmp
+from Icmp import IcmpPacket
+
+try:
+    import _checksum
+except ImportError:
+    _checksum = None
+
+try:
+    import _tunnel
+except ImportError:
+    _tunnel = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def ReferenceChecksum(data):
+    """RFC 1071 checksum summed one 16 bit word at a time
+    """
+    if len(data) & 1:
+        data = bytes(data) + b"\x00"
+
+    checksum = 0
+    for (word,) in struct.iter_unpack("!H", data):
+        checksum += word
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
+
+    return ~checksum & 0xFFFF
+
+
+def CarryHeavyInputs():
+    """Buffers whose sums carry out of every accumulator, with leftovers on each side of the SIMD size
+    """
+    inputs = [b"\xff" * 16 + b"\x01" + b"\x00" * 7, b"\xff" * 8 + b"\x00\x01"]
+    for size in (1, 7, 8, 9, 63, 64, 65, 255, 256, 257, 1023, 8192, 65535):
+        inputs.append(b"\xff" * size)
+        inputs.append(b"\xff" * (size - 1) + b"\x01")
+
+    generator = random.Random(1071)
+    for _ in range(200):
+        size = generator.randrange(1, 600)
+        inputs.append(bytes(generator.choice((0x00, 0x01, 0xfe, 0xff)) for _ in range(size)))
+
+    return inputs
+
+
+@unittest.skipIf(_checksum is None, "_checksum isn't built, run setup.py build_ext --inplace")
+class ChecksumTest(unittest.TestCase):
+
+    def testCarryHeavy(self):
+        for data in CarryHeavyInputs():
+            self.assertEqual(_checksum.checksum(data), ReferenceChecksum(data), len(data))
+
+
+class ChecksumFallbackTest(unittest.TestCase):
+    """IcmpPacket.Checksum without the _checksum extension, one fallback at a time
+    """
+
+    def setUp(self):
+        self._saved = (Icmp._checksum, Icmp._checksum_nb, Icmp.numpy)
+        Icmp._checksum = None
+
+    def tearDown(self):
+        Icmp._checksum, Icmp._checksum_nb, Icmp.numpy = self._saved
+
+    def assertMatchesReference(self):
+        # Sums to 0 mod 0xFFFF without being 0, empty, all zeros and sizes around the numpy threshold
+        inputs = CarryHeavyInputs() + [b"", b"\x00", b"\x00" * 1025, b"\xff\xff", b"\x00\x01\xff\xfe", b"\xff\xfe\x01"]
+        generator = random.Random(791)
+        for size in (1023, 1024, 1025, 4097, 8191, 8193):
+            inputs.append(bytes(generator.getrandbits(8) for _ in range(size)))
+
+        for data in inputs:
+            for packet in (data, bytearray(data), memoryview(bytearray(data))):
+                self.assertEqual(IcmpPacket.Checksum(packet), ReferenceChecksum(data), (type(packet), len(data)))
+
+    def testIntegerSum(self):
+        Icmp._checksum_nb = None
+        Icmp.numpy = None
+        self.assertMatchesReference()
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def testNumpy(self):
+        Icmp._checksum_nb = None
+        Icmp.numpy = numpy
+        self.assertMatchesReference()
+
+    @unittest.skipIf(Icmp._checksum_nb is None, "numba isn't installed, or isn't imported when _checksum is built")
+    def testNumba(self):
+        self.assertMatchesReference()
+
+
+@unittest.skipIf(_tunnel is None, "_tunnel isn't built, run setup.py build_ext --inplace")
+class WriteHeaderTest(unittest.TestCase):
+
+    def testCarryHeavy(self):
+        dstPacked = bytes(4)
+        for data in CarryHeavyInputs():
+            size = IcmpPacket.ICMP_HEADER_SIZE + len(data)
+            buffer = bytearray(size)
+            buffer[IcmpPacket.ICMP_HEADER_SIZE:] = data
+            _tunnel.write_header(buffer, size, 0, 0, 0xffff, 0xffff, dstPacked, 0xffff, IcmpPacket.MAGIC)
+
+            # A packet with a correct checksum sums to 0
+            self.assertEqual(ReferenceChecksum(buffer), 0, len(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import socket
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from Icmp import IcmpPacket, ICMP_ECHO_REPLY, ICMP_ECHO_REQUEST
+
+
+def IpHeader(srcIp, size):
+    """Minimal IPv4 header, as raw sockets receive it in front of the ICMP packet
+    """
+    return struct.pack(IcmpPacket.IP_HEADER, 0x45, 0, IcmpPacket.IP_HEADER_SIZE + size, 0, 0, 64, socket.IPPROTO_ICMP, 0,
+                       socket.inet_aton(srcIp), socket.inet_aton("127.0.0.1"))
+
+
+class TryParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.packet = bytes(IcmpPacket(ICMP_ECHO_REQUEST, 0, 0, 0x1234, 7, b"payload", None, ("10.0.0.2", 8080)).Create())
+
+    def assertTunnelPacket(self, parsed, srcIp):
+        self.assertIsNotNone(parsed)
+        self.assertEqual(parsed.type, ICMP_ECHO_REQUEST)
+        self.assertEqual(parsed.id, 0x1234)
+        self.assertEqual(parsed.sequence, 7)
+        self.assertEqual(parsed.dst, ("10.0.0.2", 8080))
+        self.assertEqual(parsed.magic, IcmpPacket.MAGIC)
+        self.assertEqual(bytes(parsed.payload), b"payload")
+        self.assertEqual(parsed.srcIp, srcIp)
+
+    def testWithIpHeader(self):
+        packet = IpHeader("10.0.0.1", len(self.packet)) + self.packet
+        self.assertTunnelPacket(IcmpPacket.TryParse(packet), "10.0.0.1")
+
+    def testWithoutIpHeader(self):
+        self.assertTunnelPacket(IcmpPacket.TryParse(self.packet, ipHeader=False), None)
+
+    def testEmptyPayload(self):
+        packet = bytes(IcmpPacket(ICMP_ECHO_REPLY, 1, 0, 0x1234, 0, b"", None, ("10.0.0.2", 8080)).Create())
+        parsed = IcmpPacket.TryParse(packet, ipHeader=False)
+        self.assertIsNotNone(parsed)
+        self.assertEqual(parsed.code, 1)
+        self.assertEqual(len(parsed.payload), 0)
+
+    def testTruncated(self):
+        packet = IpHeader("10.0.0.1", len(self.packet)) + self.packet
+        for size in (0, IcmpPacket.IP_HEADER_SIZE, IcmpPacket.IP_HEADER_SIZE + IcmpPacket.ICMP_HEADER_SIZE - 1):
+            self.assertIsNone(IcmpPacket.TryParse(packet[:size]), size)
+
+        for size in (0, IcmpPacket.MAGIC_OFFSET, IcmpPacket.ICMP_HEADER_SIZE - 1):
+            self.assertIsNone(IcmpPacket.TryParse(self.packet[:size], ipHeader=False), size)
+
+    def testForeignPacket(self):
+        # A plain ping, like the ones the ping command sends
+        ping = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, 1, 1) + bytes(range(56))
+        self.assertIsNone(IcmpPacket.TryParse(IpHeader("10.0.0.1", len(ping)) + ping))
+        self.assertIsNone(IcmpPacket.TryParse(ping, ipHeader=False))
+
+    def testIpHeaderMismatch(self):
+        # The magic is looked for where the header says it is
+        self.assertIsNone(IcmpPacket.TryParse(self.packet))
+        self.assertIsNone(IcmpPacket.TryParse(IpHeader("10.0.0.1", len(self.packet)) + self.packet, ipHeader=False))
+
+
+if __name__ == "__main__":
+    unittest.main()